@@ -1,10 +1,20 @@
-from flask import Flask, make_response, request
+import tracemalloc
+from time import perf_counter
+from typing import NamedTuple, Optional
+
+from flask import Flask, abort, jsonify, make_response, request
 from flask_sqlalchemy import SQLAlchemy
 
+from bulk import benchmark_inserts, bulk_insert, check_rows
+from caching import ObjectCache
+from streaming import stream_json
+
 app = Flask(__name__)  # Create Flask App
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'  # In memory SQLITE
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False  # SQLA will complain if this is True
 app.config['SQLALCHEMY_ECHO'] = False  # Print all DB transactions
+# Keep the computers that get_device reads in memory, for all requests
+app.config['COMPUTER_CACHE'] = False
 
 db = SQLAlchemy(app, session_options={
     'autoflush': False
@@ -21,6 +31,35 @@ class Computer(db.Model):
         return f'<Computer {self.id} model={self.model} S/N={self.serial_number}>'
 
 
+class ComputerRow(NamedTuple):
+    """A read-only computer with the columns we print.
+
+    Loading a Computer creates an object that the session tracks (identity
+    map, changes...). When we only read some columns, a tuple is much cheaper.
+    """
+    id: int
+    model: str
+    serial_number: str
+
+    def __repr__(self) -> str:
+        return f'<Computer {self.id} model={self.model} S/N={self.serial_number}>'
+
+
+# A SQLA Core select, like in a0_intro.py, of the columns of ComputerRow
+computer_row_select = db.select([Computer.id, Computer.model, Computer.serial_number])
+# Building a select and compiling it to SQL takes more Python than running
+# it in the DB. So we build it once, with the ID as a parameter, and
+# SQLAlchemy compiles it once and keeps the SQL in compiled_cache
+# (see get_device). sqlite3 then reuses its prepared statement for the
+# SQL (it keeps the last 100), so SQLite doesn't parse it again either
+computer_by_id_select = computer_row_select.where(Computer.id == db.bindparam('id'))
+compiled_cache = {}
+# When COMPUTER_CACHE, get_device reads each computer from the DB once, and
+# then from here. As ComputerRow is read-only, all requests can share them.
+# Changes to computers through the session (not bulk_insert) remove them
+computer_cache = ObjectCache(max_size=10000, ttl=60)
+computer_cache.watch(db.session, Computer)
+
 db.create_all()
 
 
@@ -40,18 +79,49 @@ def post_device():
     return r
 
 
+@app.route('/batch/', methods={'POST'})
+def post_devices():
+    """Creates many PCs in bulk, returning their IDs.
+
+    Pass-in a JSON array of PCs, like
+    ``[{"model": "foo", "manufacturer": "bar", "serial_number": "sn1"}]``.
+    The IDs are returned in the same order.
+    """
+    try:
+        rows = check_rows(Computer, request.get_json())
+    except ValueError as e:
+        return make_response(str(e), 400)
+    # We skip the ORM (no Computer objects): faster for many PCs
+    ids = bulk_insert(db.session, Computer, rows)
+    db.session.commit()
+    return jsonify(ids)
+
+
 @app.route('/<int:id>')
 def get_device(id: int):
     """Gets a PC by its ID."""
-    select_query = Computer.query.filter(Computer.id == id)
-    pc = select_query.one()
+    if app.config['COMPUTER_CACHE']:
+        pc = computer_cache.get_or_load(Computer, id, lambda: load_computer_row(id))
+    else:
+        pc = load_computer_row(id)
+    if pc is None:
+        abort(404)
     return make_response(str(pc))
 
 
+def load_computer_row(id: int) -> Optional[ComputerRow]:
+    # We only print it, so we skip the ORM
+    connection = db.session.connection().execution_options(compiled_cache=compiled_cache)
+    row = connection.execute(computer_by_id_select, id=id).first()
+    return ComputerRow(*row) if row is not None else None
+
+
 @app.route('/')
 def get_devices():
-    """Gets all computers."""
-    return make_response(str(tuple(Computer.query)))
+    """Gets all computers, streaming them as JSON."""
+    # with_entities returns tuples of these columns, not Computer objects
+    columns = Computer.id, Computer.model, Computer.manufacturer, Computer.serial_number
+    return stream_json(Computer.query.with_entities(*columns).order_by(Computer.id))
 
 
 # Tests
@@ -62,6 +132,19 @@ print('Response:', client.post('/').data)
 print('Get the first device (ID = 1):')
 print('Response:', client.get('/1').data)
 
+print('Get the first device twice, with the cache:')
+app.config['COMPUTER_CACHE'] = True
+assert client.get('/1').data == client.get('/1').data
+assert (computer_cache.hits, computer_cache.misses) == (1, 1), str(computer_cache)
+Computer.query.get(1).model = 'baz'  # Changing it removes it from the cache
+db.session.commit()
+print('Response after changing it:', client.get('/1').data)
+assert b'model=baz' in client.get('/1').data, 'The cache returned the old computer'
+assert client.get('/404').status_code == 404
+print(computer_cache)
+app.config['COMPUTER_CACHE'] = False
+assert client.get('/404').status_code == 404
+
 print('Get all devices (although there is only one):')
 print('Response:', client.get('/').data)
 
@@ -76,3 +159,114 @@ def get_device_wtf_query(id: int):
 
 print('Complicated filter:')
 print('Response:', client.get('/wtf/1').data)
+
+print('Create two devices in bulk (ID = 2, 3):')
+print('Response:', client.post('/batch/', json=[
+    {'model': 'foo', 'manufacturer': 'bar', 'serial_number': 'sn2'},
+    {'model': 'spam', 'manufacturer': 'eggs', 'serial_number': 'sn3'}
+]).data)
+print('Wrong devices are a 400, with nothing inserted:')
+for wrong in {'model': 'foo'}, [{'model': 'foo', 'manufacturer': 'bar'}], [{'color': 'red'}]:
+    response = client.post('/batch/', json=wrong)
+    print('Response:', response.data)
+    assert response.status_code == 400
+print('Get all devices:')
+print('Response:', client.get('/').data)
+print('Get all devices, one JSON per line:')
+print('Response:', client.get('/', headers={'Accept': 'application/x-ndjson'}).data)
+
+
+# Benchmark
+def insert_orm(size: int):
+    db.session.add_all(Computer(model='foo', manufacturer='bar', serial_number=f'sn{i}')
+                       for i in range(size))
+    db.session.flush()
+    db.session.rollback()
+
+
+def insert_bulk(size: int):
+    bulk_insert(db.session, Computer, [
+        dict(model='foo', manufacturer='bar', serial_number=f'sn{i}') for i in range(size)
+    ])
+    db.session.rollback()
+
+
+print('Benchmark inserting computers:')
+# Add 100000, 1000000... to see how it grows
+benchmark_inserts({'orm': insert_orm, 'bulk': insert_bulk}, (1000, 10000))
+
+
+def benchmark_reads(size: int):
+    """Prints the rows/sec and the memory per row of loading
+    computers as ORM objects, as tuples through with_entities,
+    and as ComputerRow through a Core select.
+    """
+    bulk_insert(db.session, Computer, [
+        dict(model='foo', manufacturer='bar', serial_number=f'sn{i}') for i in range(size)
+    ])
+    reads = {
+        'entities': lambda: Computer.query.all(),
+        'with_entities': lambda: Computer.query.with_entities(
+            Computer.id, Computer.model, Computer.serial_number
+        ).all(),
+        'core': lambda: [ComputerRow(*row) for row in db.session.execute(computer_row_select)]
+    }
+    print(f'Benchmark reading {size} computers:')
+    for name, read in reads.items():
+        db.session.expunge_all()
+        start = perf_counter()
+        read()
+        rows_sec = size / (perf_counter() - start)
+        db.session.expunge_all()
+        # What stays allocated while we hold the rows (objects, states, tuples...)
+        tracemalloc.start()
+        rows = read()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        stats = snapshot.statistics('filename')
+        blocks = sum(stat.count for stat in stats) / len(rows)
+        size_row = sum(stat.size for stat in stats) / len(rows)
+        print(f'{name}: {rows_sec:.0f} rows/sec, {blocks:.1f} allocations '
+              f'and {size_row:.0f} bytes per row')
+        del rows
+    db.session.rollback()
+
+
+benchmark_reads(50000)
+
+
+def benchmark_get_device(times: int):
+    """Prints the microseconds it takes to get a PC by ID as
+    get_device did before (the ORM, and a select built each time),
+    and as it does now, without and with the cache.
+
+    The second time, query.get() finds the computers in the identity
+    map of the session (filter().one() always queries), and the cache
+    has them (the cache lasts across requests; the identity map doesn't).
+    """
+    gets = {
+        'orm': lambda id: Computer.query.filter(Computer.id == id).one(),
+        'orm get()': lambda id: Computer.query.get(id),
+        'core': lambda id: ComputerRow(*db.session.execute(
+            computer_row_select.where(Computer.id == id)
+        ).first()),
+        'core compiled once': load_computer_row,
+        'cache': lambda id: computer_cache.get_or_load(Computer, id, lambda: load_computer_row(id))
+    }
+    ids = bulk_insert(db.session, Computer, [
+        dict(model='foo', manufacturer='bar', serial_number=f'sn{i}') for i in range(times)
+    ])
+    print('Benchmark getting a computer by ID (SQLite):')
+    for name, get in gets.items():
+        db.session.expunge_all()
+        computer_cache.clear()
+        loaded = []  # The identity map only keeps the objects we hold
+        for again in ('', ', again'):
+            start = perf_counter()
+            loaded += [get(id) for id in ids]
+            print(f'{name}{again}: {(perf_counter() - start) / times * 10 ** 6:.1f}µs per get')
+    db.session.rollback()
+    computer_cache.clear()  # The rolled back computers
+
+
+benchmark_get_device(10000)
@@ -0,0 +1,130 @@
+"""
+Querying Postgres from asyncio.
+
+SQLAlchemy (1.3) and its drivers block the thread while waiting for
+the DB. psycopg2 can also run asynchronously: it starts the query
+and tells us which socket to wait on, so asyncio can do other work
+meanwhile (this is how aiopg works). We build the queries with
+SQLAlchemy Core and run them this way.
+
+Note that the results are the rows of psycopg2, without the types
+of SQLAlchemy (i.e. an Enum column returns the str).
+
+Used by the examples, like in ``i_async.py``.
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, List, Optional
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+from sqlalchemy.dialects.postgresql import psycopg2 as psycopg2_dialect
+
+_dialect = psycopg2_dialect.dialect()
+
+
+async def _wait(connection):
+    """Waits until psycopg2 finishes what the connection is doing."""
+    loop = asyncio.get_event_loop()
+    while True:
+        state = connection.poll()  # Raises the errors of the query
+        if state == psycopg2.extensions.POLL_OK:
+            return
+        future = loop.create_future()
+        if state == psycopg2.extensions.POLL_READ:
+            add, remove = loop.add_reader, loop.remove_reader
+        else:
+            add, remove = loop.add_writer, loop.remove_writer
+        fd = connection.fileno()
+        add(fd, future.set_result, None)
+        try:
+            await future
+        finally:
+            remove(fd)
+
+
+class AsyncConnection:
+    """An asynchronous psycopg2 connection.
+
+    These connections are always in autocommit; use
+    AsyncPool.transaction to run statements in a transaction.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    @classmethod
+    async def connect(cls, dsn: str) -> 'AsyncConnection':
+        connection = psycopg2.connect(dsn, async_=True)
+        await _wait(connection)
+        return cls(connection)
+
+    async def execute(self, statement, params: Optional[dict] = None) -> List:
+        """Runs the statement, returning its rows as named tuples.
+
+        :param statement: An SQLAlchemy Core statement, or SQL.
+        :param params: The parameters of the statement.
+        """
+        if not isinstance(statement, str):
+            compiled = statement.compile(dialect=_dialect)
+            statement, params = str(compiled), compiled.construct_params(params)
+        cursor = self.connection.cursor(cursor_factory=psycopg2.extras.NamedTupleCursor)
+        cursor.execute(statement, params)
+        await _wait(self.connection)
+        return cursor.fetchall() if cursor.description else []
+
+    def close(self):
+        self.connection.close()
+
+
+class AsyncPool:
+    """Up to ``size`` AsyncConnection, opened when needed.
+
+    Each connection is used by one task at a time; the other
+    tasks wait for a free one.
+    """
+
+    def __init__(self, dsn: str, size: int = 10):
+        self.dsn = dsn
+        self.size = size
+        self._idle: List[AsyncConnection] = []
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    @asynccontextmanager
+    async def connection(self) -> AsyncIterator[AsyncConnection]:
+        if self._semaphore is None:  # In the event loop that uses the pool
+            self._semaphore = asyncio.Semaphore(self.size)
+        async with self._semaphore:
+            connection = self._idle.pop() if self._idle else \
+                await AsyncConnection.connect(self.dsn)
+            try:
+                yield connection
+            except BaseException:  # Including being cancelled
+                # We don't know in which state the connection is
+                connection.close()
+                raise
+            self._idle.append(connection)
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator[AsyncConnection]:
+        """A connection in a transaction, committed when
+        exiting the context, or rolled back if it raises.
+        """
+        async with self.connection() as connection:
+            await connection.execute('BEGIN')
+            try:
+                yield connection
+            except Exception:
+                await connection.execute('ROLLBACK')
+                raise
+            await connection.execute('COMMIT')
+
+    def close(self):
+        """Closes the connections. Call it before the event loop
+        finishes; the pool can then be used in another loop.
+        """
+        while self._idle:
+            self._idle.pop().close()
+        self._semaphore = None
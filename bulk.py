@@ -0,0 +1,228 @@
+"""
+Inserting many rows at once.
+
+The ORM inserts objects through the unit of work: it creates one
+Python object per row, tracks its state, and emits the INSERTs
+(at best as an executemany). For thousands of rows it is
+faster to skip the ORM and talk to the DB directly:
+
+- In Postgres we ``COPY`` the rows, which is the fastest way to
+  load data. ``COPY`` cannot return the generated IDs, so we first
+  reserve them from the sequence of the primary key.
+- In other DBs we use an ``executemany``.
+
+Used by the examples, like in ``c_inheritance.py``.
+"""
+
+import io
+import tracemalloc
+from decimal import Decimal
+from time import perf_counter
+from typing import Callable, Dict, Iterable, List, Sequence
+
+from sqlalchemy import Table
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session, class_mapper
+
+
+def bulk_insert(session: Session, model, rows: Sequence[dict]) -> List:
+    """Inserts the rows of the passed-in model in bulk, returning
+    their primary keys in the same order as the rows.
+
+    This works with joined-table inheritance (we write in all the
+    tables of the model) and sets the polymorphic identity.
+    Python-side column defaults are applied, server-side
+    defaults are left to the DB.
+
+    :param model: The mapped class, like ``Computer``.
+    :param rows: A dict per row, mapping column names to values.
+        Rows without primary key get one from the DB. Outside
+        Postgres, either all the rows or none have a primary key.
+        In Postgres the values are converted by the type of their
+        column, as in an INSERT, and written as text: values that
+        are still lists or dicts (i.e. an ARRAY column) raise
+        ValueError.
+    """
+    mapper = class_mapper(model)
+    base = mapper.tables[0]
+    rows = [dict(row) for row in rows]
+    if not rows:
+        return []
+    if mapper.polymorphic_on is not None:
+        for row in rows:
+            row[mapper.polymorphic_on.key] = mapper.polymorphic_identity
+
+    pk, *other_pks = base.primary_key.columns
+    # Only an integer primary key that the DB generates (i.e. a SERIAL), as
+    # SQLAlchemy decides; autoincrement is also 'auto' for, i.e., a string
+    missing = [row for row in rows if row.get(pk.key) is None] \
+        if base._autoincrement_column is pk and pk.default is None else []
+    postgres = session.get_bind().dialect.name == 'postgresql'
+    if missing and postgres:
+        for row, id in zip(missing, _reserve_ids(session, pk, len(missing))):
+            row[pk.key] = id
+        missing = []
+    if missing and len(missing) < len(rows):
+        # We read the generated IDs as the last ones, so all must be generated
+        raise ValueError(f'Pass the {pk.key} of all the rows or of none of them.')
+    generate_ids = bool(missing)
+
+    for table in mapper.tables:
+        if table is not base:
+            # Sub-tables share the ID of the base table
+            for row in rows:
+                row.update({c.key: row[pk.key] for c in table.primary_key.columns})
+        table_rows = _table_rows(table, rows)
+        for row, table_row in zip(rows, table_rows):
+            row.update(table_row)  # i.e. the IDs set by a Python default
+        if postgres:
+            _copy(session, table, table_rows)
+        else:
+            session.execute(table.insert(), table_rows)
+        if generate_ids:
+            # An INTEGER PRIMARY KEY in SQLite is the biggest one + 1, and
+            # nobody else can write until we commit, so our IDs are the last ones
+            last_id = session.execute(f'SELECT max({pk.name}) FROM {table.name}').scalar()
+            for row, id in zip(rows, range(last_id - len(rows) + 1, last_id + 1)):
+                row[pk.key] = id
+            generate_ids = False
+    return [tuple(row[c.key] for c in base.primary_key.columns) if other_pks else row[pk.key]
+            for row in rows]
+
+
+def check_rows(model, rows, given: Iterable[str] = ()) -> List[dict]:
+    """Checks the rows to pass to bulk_insert, i.e. the JSON of a
+    request, returning them. Raises ValueError saying what is wrong:
+    rows that are not objects, unknown columns, or missing values of
+    required columns (not nullable and without a default).
+
+    The values themselves are checked by the DB when inserting.
+
+    :param given: The required columns that we set ourselves afterwards,
+                  like a foreign key.
+    """
+    if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+        raise ValueError('Pass-in a JSON array of objects.')
+    mapper = class_mapper(model)
+    base = mapper.tables[0]
+    columns = {c.key: c for table in mapper.tables for c in table.columns}
+    # The values that bulk_insert, or the caller, sets
+    filled = {c.key for table in mapper.tables[1:] for c in table.primary_key.columns}
+    filled.update(given)
+    if base._autoincrement_column is not None:
+        filled.add(base._autoincrement_column.key)
+    if mapper.polymorphic_on is not None:
+        filled.add(mapper.polymorphic_on.key)
+    required = {key for key, c in columns.items()
+                if not c.nullable and c.default is None and c.server_default is None} - filled
+    for i, row in enumerate(rows):
+        unknown = row.keys() - columns.keys()
+        if unknown:
+            raise ValueError(f'Row {i} has unknown fields: {", ".join(sorted(unknown))}.')
+        missing = [key for key in required if row.get(key) is None]
+        if missing:
+            raise ValueError(f'Row {i} misses fields: {", ".join(sorted(missing))}.')
+    return rows
+
+
+def _reserve_ids(session: Session, pk, n: int) -> List[int]:
+    """Gets ``n`` IDs from the sequence of the passed-in primary key."""
+    query = 'SELECT nextval(pg_get_serial_sequence(:table, :column)) FROM generate_series(1, :n)'
+    result = session.execute(query, {'table': pk.table.name, 'column': pk.name, 'n': n})
+    return [id for id, in result]
+
+
+def _table_rows(table: Table, rows: Iterable[dict]) -> List[Dict]:
+    """Takes the values of the columns of the table from the rows,
+    filling the missing values with the Python-side defaults.
+
+    Columns not in any row and without a Python default are left out,
+    so the DB sets them (i.e. to their server default).
+    """
+    rows = tuple(rows)
+    keys = set().union(*rows)
+    columns = [c for c in table.columns
+               if c.key in keys or (c.default is not None and not c.default.is_sequence)]
+    table_rows = []
+    for row in rows:
+        table_row = {}
+        for c in columns:
+            if c.key in row:
+                table_row[c.key] = row[c.key]
+            elif c.default is not None and c.default.is_callable:
+                table_row[c.key] = c.default.arg(None)
+            elif c.default is not None:
+                table_row[c.key] = c.default.arg
+            else:
+                table_row[c.key] = None
+        table_rows.append(table_row)
+    return table_rows
+
+
+def _copy(session: Session, table: Table, rows: List[Dict]):
+    """Writes the rows to the table through a Postgres COPY."""
+    columns = list(rows[0])
+    connection = session.connection()
+    dialect = connection.dialect
+    # As in an INSERT, the type of the column converts the values,
+    # i.e. an Enum to its name or a dict to JSON
+    processors = [table.c[c].type.dialect_impl(dialect).bind_processor(dialect) or _same
+                  for c in columns]
+    data = io.StringIO()
+    data.writelines(','.join(_csv_value(process(row[c]))
+                             for c, process in zip(columns, processors)) + '\n'
+                    for row in rows)
+    data.seek(0)
+    names = ', '.join(f'"{table.c[c].name}"' for c in columns)
+    statement = f'COPY "{table.name}" ({names}) FROM STDIN WITH CSV'
+    try:
+        connection.connection.cursor().copy_expert(statement, data)
+    except connection.dialect.dbapi.Error as e:
+        # The same exceptions as SQLAlchemy, i.e. IntegrityError
+        raise DBAPIError.instance(statement, None, e, connection.dialect.dbapi.Error)
+
+
+def _same(value):
+    return value
+
+
+def _csv_value(value) -> str:
+    # In COPY's CSV an unquoted empty value is NULL and a quoted one
+    # is an empty string, so we quote all values except the None
+    # (the csv module would quote it too)
+    if value is None:
+        return ''
+    if isinstance(value, (int, float, Decimal)) and not isinstance(value, bool):
+        return str(value)
+    # psycopg2.Binary, from the types of binary columns, wraps the bytes
+    value = getattr(value, 'adapted', value)
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return '\\x' + bytes(value).hex()  # The hex format of bytea
+    if isinstance(value, (dict, list, tuple, set)):
+        # str() would write their repr, and Postgres arrays have their own syntax
+        raise ValueError(f'Cannot COPY the {type(value).__name__} {value!r}: '
+                         'only scalar and JSON columns are supported.')
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+def benchmark_inserts(inserts: Dict[str, Callable[[int], None]], sizes: Iterable[int]):
+    """Prints the rows/sec and the peak memory of each insert function
+    for each size.
+
+    Memory is the peak of the Python allocations, measured in a
+    second run, as tracing them slows down the first.
+
+    :param inserts: A function per name, which inserts the passed-in
+        number of rows (and rolls back).
+    """
+    for size in sizes:
+        for name, insert in inserts.items():
+            start = perf_counter()
+            insert(size)
+            rows_sec = size / (perf_counter() - start)
+            tracemalloc.start()
+            insert(size)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f'{size} rows, {name}: {rows_sec:.0f} rows/sec, '
+                  f'peak memory {peak / 2 ** 20:.1f} MB')
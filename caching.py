@@ -0,0 +1,139 @@
+"""
+Caching across requests.
+
+The session's identity map only lives for a request: the next request
+loads the same row from the DB again. For results that are read much
+more than written, we can keep them in memory for all the requests, as
+long as we forget them when they change.
+
+Used by the examples, like in ``a1_intro.py`` and ``g_natural_search.py``.
+"""
+
+import threading
+from collections import OrderedDict
+from itertools import chain
+from time import monotonic
+from typing import Any, Callable, Hashable, Optional
+
+from sqlalchemy import event, inspect
+
+
+class TTLCache:
+    """A thread-safe LRU cache with a TTL.
+
+    Values expire after ``ttl`` seconds, and when there are more
+    than ``max_size`` values the least recently used is dropped.
+    ``hits`` and ``misses`` count the gets.
+
+    Each clear or pop starts a new ``generation``. Read it before
+    computing a value to set: if the cache forgets values meanwhile,
+    the value may be stale and set ignores it.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = self.misses = 0
+        self.generation = 0
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            value, expires = self._values.get(key, (None, 0))
+            if expires < monotonic():
+                self._values.pop(key, None)
+                self.misses += 1
+                return None
+            self._values.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any, generation: int):
+        """:param generation: The generation when we started computing the value."""
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._values[key] = value, monotonic() + self.ttl
+            self._values.move_to_end(key)
+            while len(self._values) > self.max_size:
+                self._values.popitem(last=False)
+
+    def pop(self, *keys: Hashable):
+        with self._lock:
+            for key in keys:
+                self._values.pop(key, None)
+            # We don't know which keys the values being computed are for
+            self.generation += 1
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self.generation += 1
+
+    def __str__(self) -> str:
+        return f'{type(self).__name__} {len(self._values)} values, ' \
+               f'{self.hits} hits, {self.misses} misses'
+
+
+class ObjectCache(TTLCache):
+    """A TTLCache of rows by their mapped class and primary key,
+    shared across requests and threads.
+
+    Cache immutable values, like a NamedTuple of the columns, not the
+    ORM objects, which belong to the session that loaded them. See
+    watch to forget the rows that change.
+    """
+
+    def get_or_load(self, model, id: Hashable,
+                    load: Callable[[], Optional[Any]]) -> Optional[Any]:
+        """The value of the row, or what ``load`` returns for it if we
+        don't have it (None is not cached, so rows can be created).
+        """
+        key = model, id
+        generation = self.generation
+        value = self.get(key)
+        if value is None:
+            value = load()  # Without the lock, so other threads don't wait for the DB
+            if value is not None:
+                self.set(key, value, generation)
+        return value
+
+    def invalidate(self, model, *ids: Hashable):
+        self.pop(*((model, id) for id in ids))
+
+    def watch(self, session, *models):
+        """Forgets the rows of the models that the session changes.
+
+        We forget them when flushing, so the session doesn't read its
+        old values, and again when committing, as meanwhile other
+        sessions could cache the committed (old) values. Changes
+        without the ORM (i.e. bulk.bulk_insert, or an UPDATE) are not
+        seen, and stay cached until they expire.
+
+        :param session: A Session, sessionmaker, or scoped_session.
+        """
+
+        def changed(session, _):
+            rows = session.info.setdefault(self, set())
+            # New rows aren't cached (we don't cache None)
+            for obj in chain(session.dirty, session.deleted):
+                model = next((model for model in models if isinstance(obj, model)), None)
+                if model is not None:
+                    rows.add((model, self._id(obj)))
+            self.pop(*rows)
+
+        def committed(session):
+            self.pop(*session.info.pop(self, ()))
+
+        def rolled_back(session, _):
+            session.info.pop(self, None)
+
+        event.listen(session, 'after_flush', changed)
+        event.listen(session, 'after_commit', committed)
+        event.listen(session, 'after_soft_rollback', rolled_back)
+
+    @staticmethod
+    def _id(obj) -> Hashable:
+        identity = inspect(obj).identity
+        return identity[0] if len(identity) == 1 else identity
@@ -0,0 +1,41 @@
+"""
+Hashing and verifying passwords in other processes.
+
+A ProcessPoolExecutor sends the function to run to its workers by
+name, and each worker imports the module of the function. With the
+``spawn`` start method (the default in Windows and macOS) or
+``forkserver`` the workers are new Python processes, which also import
+the script we ran, as ``__mp_main__``. So the functions live here, in
+a module without side effects, and the scripts using them run their
+examples only ``if __name__ == '__main__'``.
+
+Used by the examples, like in ``d_types.py``.
+"""
+
+from functools import lru_cache
+from typing import Tuple
+
+from passlib.context import CryptContext
+
+
+def context_settings(rounds: int) -> dict:
+    """The settings of the CryptContext, i.e. for
+    ``sqlalchemy_utils.PasswordType(**context_settings(rounds))``.
+
+    :param rounds: The work factor: the more, the slower to hash.
+    """
+    return {'schemes': {'pbkdf2_sha256'}, 'pbkdf2_sha256__default_rounds': rounds}
+
+
+@lru_cache()
+def context(rounds: int) -> CryptContext:
+    """The CryptContext of the worker, created once per rounds."""
+    return CryptContext(**context_settings(rounds))
+
+
+def hash_password(secret: str, rounds: int) -> str:
+    return context(rounds).hash(secret)
+
+
+def verify_password(secret_and_hash: Tuple[str, bytes], rounds: int) -> bool:
+    return context(rounds).verify(*secret_and_hash)
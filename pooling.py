@@ -0,0 +1,163 @@
+"""
+Configuring and watching the pool of connections to the DB.
+
+SQLAlchemy keeps a pool of connections per engine. When all of them
+are in use, requests wait for one (or open an "overflow" connection),
+which doesn't show anywhere except in slower responses. We create the
+engines with the same pool settings and measure the pool: how long
+checking out a connection takes, how many connections are in use and
+idle, and how many we open and close.
+
+For Flask-SQLAlchemy::
+
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(pool_size=10)
+    ...
+    print(db.engine.pool.metrics.snapshot())
+
+Used by the examples, like in ``b0_relationships_basic.py``.
+"""
+
+import threading
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from typing import Dict, Iterable
+
+import sqlalchemy as sa
+from flask import Flask
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+
+def engine_options(**options) -> dict:
+    """The options of our engines, for ``create_engine`` or
+    ``SQLALCHEMY_ENGINE_OPTIONS``. Override any with the keyword arguments.
+
+    - ``pool_size``: connections kept open.
+    - ``max_overflow``: connections opened over ``pool_size`` when
+      all are in use, and closed once returned.
+    - ``pool_timeout``: seconds to wait for a connection before failing.
+    - ``pool_pre_ping``: test the connection when checking it out,
+      replacing it if the DB closed it (i.e. after a restart).
+    - ``pool_recycle``: seconds after which we replace a connection,
+      before the DB or a proxy closes it for being idle.
+    """
+    return dict(dict(poolclass=InstrumentedQueuePool,
+                     pool_size=5,
+                     max_overflow=10,
+                     pool_timeout=30,
+                     pool_pre_ping=True,
+                     pool_recycle=1800), **options)
+
+
+def create_engine(url: str, **options) -> Engine:
+    """sqlalchemy.create_engine with engine_options."""
+    return sa.create_engine(url, **engine_options(**options))
+
+
+class PoolMetrics:
+    """What happens in a pool. Thread-safe."""
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, float('inf'))
+    """The upper bounds, in seconds, of the buckets of the checkout histogram."""
+
+    def __init__(self, pool: QueuePool):
+        self.pool = pool
+        self._lock = threading.Lock()
+        self.reset()
+        event.listen(pool, 'checkout', self._checkout)
+        event.listen(pool, 'connect', lambda *_: self._count('connects'))
+        event.listen(pool, 'close', lambda *_: self._count('closes'))
+        event.listen(pool, 'invalidate', lambda *_: self._count('invalidations'))
+
+    def reset(self):
+        """Resets the counters and the histogram, not the gauges."""
+        with self._lock:
+            self.checkouts = [0] * len(self.BUCKETS)
+            self.checkout_seconds = 0.0
+            self.max_checkout_seconds = 0.0
+            self.max_in_use = 0
+            self.counts = {'connects': 0, 'closes': 0, 'invalidations': 0}
+
+    def _count(self, name: str):
+        with self._lock:
+            self.counts[name] += 1
+
+    def _checkout(self, *_):
+        with self._lock:
+            self.max_in_use = max(self.max_in_use, self.pool.checkedout())
+
+    def checked_out(self, seconds: float):
+        with self._lock:
+            self.checkouts[bisect_left(self.BUCKETS, seconds)] += 1
+            self.checkout_seconds += seconds
+            self.max_checkout_seconds = max(self.max_checkout_seconds, seconds)
+
+    def snapshot(self) -> Dict:
+        """The metrics now, as a dict.
+
+        ``checkout_histogram`` maps the upper bound of each bucket to the
+        checkouts that took at most that many seconds (and more than the
+        previous bucket). ``in_use``, ``idle`` and ``overflow`` are the
+        connections now, ``max_in_use`` since the reset.
+        """
+        with self._lock:
+            return dict(self.counts,
+                        checkouts=sum(self.checkouts),
+                        checkout_histogram=dict(zip(self.BUCKETS, self.checkouts)),
+                        checkout_seconds=self.checkout_seconds,
+                        max_checkout_seconds=self.max_checkout_seconds,
+                        max_in_use=self.max_in_use,
+                        in_use=self.pool.checkedout(),
+                        idle=self.pool.checkedin(),
+                        overflow=max(self.pool.overflow(), 0),
+                        size=self.pool.size())
+
+
+class InstrumentedQueuePool(QueuePool):
+    """A QueuePool with PoolMetrics in ``metrics``."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics(self)
+
+    def connect(self):
+        # Includes waiting for a free connection, opening a new
+        # one, and the pre-ping
+        start = perf_counter()
+        try:
+            return super().connect()
+        finally:
+            self.metrics.checked_out(perf_counter() - start)
+
+
+def benchmark_pool(app: Flask, engine: Engine, path: str, clients: Iterable[int], requests: int):
+    """Prints the requests/sec and the pool metrics when ``clients``
+    Flask test clients GET the ``path`` at the same time, each
+    ``requests`` times.
+    """
+    print(f'Benchmark GET {path} with a pool of {engine.pool.size()}:')
+
+    def run_client(_):
+        client = app.test_client()
+        latencies = []
+        for _ in range(requests):
+            start = perf_counter()
+            assert client.get(path).status_code == 200
+            latencies.append(perf_counter() - start)
+        return latencies
+
+    for n in clients:
+        pool = engine.pool  # Disposing the engine replaces the pool
+        pool.metrics.reset()
+        start = perf_counter()
+        with ThreadPoolExecutor(n) as executor:
+            latencies = sorted(sum(executor.map(run_client, range(n)), []))
+        seconds = perf_counter() - start
+        metrics = pool.metrics.snapshot()
+        p99 = latencies[int(len(latencies) * 0.99)] * 1000
+        wait = metrics['checkout_seconds'] / metrics['checkouts'] * 1000
+        print(f'{n} clients: {len(latencies) / seconds:.0f} requests/sec, p99 {p99:.1f}ms, '
+              f'checkout avg {wait:.2f}ms max {metrics["max_checkout_seconds"] * 1000:.1f}ms, '
+              f'{metrics["max_in_use"]} connections in use at most, '
+              f'{metrics["connects"]} opened, {metrics["closes"]} closed')
@@ -0,0 +1,174 @@
+"""
+Knowing what SQL our code sends to the DB.
+
+Used by the examples, like in ``b0_relationships_basic.py``.
+"""
+
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Callable, Dict, Iterator, List, NamedTuple
+
+from flask import Flask, Response, g, has_request_context, jsonify, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class Statement(NamedTuple):
+    sql: str
+    rows: int
+    """The rows the statement returned or changed, as the DBAPI
+    says. In SQLite this is -1 for SELECT.
+    """
+    seconds: float = 0.0
+    """How long the DB took to execute it, without fetching the rows."""
+
+
+def _listen_timed(engine: Engine, callback: Callable) -> Callable[[], None]:
+    """Calls ``callback(conn, cursor, statement, parameters, executemany,
+    seconds)`` after each statement executed in the engine.
+
+    Returns a function that stops listening.
+    """
+    key = object()  # Each listener times on its own
+
+    def before(conn, *_):
+        conn.info.setdefault(key, []).append(perf_counter())
+
+    def after(conn, cursor, statement, parameters, context, executemany):
+        seconds = perf_counter() - conn.info[key].pop()
+        callback(conn, cursor, statement, parameters, executemany, seconds)
+
+    event.listen(engine, 'before_cursor_execute', before)
+    event.listen(engine, 'after_cursor_execute', after)
+
+    def remove():
+        event.remove(engine, 'before_cursor_execute', before)
+        event.remove(engine, 'after_cursor_execute', after)
+
+    return remove
+
+
+@contextmanager
+def count_queries(engine: Engine) -> Iterator[List[Statement]]:
+    """Collects the statements executed in the engine
+    while in the context. Use it to check that some code runs
+    a bounded number of queries::
+
+        with count_queries(db.engine) as statements:
+            client.get('/users/')
+        assert len(statements) == 2
+    """
+    statements = []
+
+    def collect(conn, cursor, statement, parameters, executemany, seconds):
+        statements.append(Statement(statement, cursor.rowcount, seconds))
+
+    remove = _listen_timed(engine, collect)
+    try:
+        yield statements
+    finally:
+        remove()
+
+
+class RequestProfiler:
+    """Profiles the SQL of each request of a Flask app, unlike echo,
+    which only prints the statements.
+
+    - Responses have the ``X-SQL-Statements`` header and the
+      time in the DB in ``Server-Timing`` (browsers show it).
+    - ``GET /_metrics`` returns, per endpoint, the requests, their
+      statements and time in the DB, and the slowest statements.
+      If the engine has a pool from pooling.py, also its metrics.
+    - Statements taking ``SQL_SLOW_SECONDS`` or more are logged as
+      warnings. In Postgres, with their plan if ``SQL_SLOW_EXPLAIN``
+      is True (EXPLAIN), or if it is 'analyze' (EXPLAIN ANALYZE for
+      SELECTs). EXPLAIN ANALYZE runs the statement again, so the
+      slowest statements take twice as long, and their side effects
+      (i.e. a nextval) happen twice.
+    """
+    SLOWEST = 5
+    """The slowest different statements kept per endpoint."""
+
+    def __init__(self, app: Flask, engine: Engine):
+        self.app = app
+        self.engine = engine
+        app.config.setdefault('SQL_SLOW_SECONDS', 0.1)
+        app.config.setdefault('SQL_SLOW_EXPLAIN', False)  # False, True, or 'analyze'
+        self.endpoints: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+        _listen_timed(engine, self._collect)
+        app.before_request(self._start)
+        app.after_request(self._finish)
+        app.add_url_rule('/_metrics', 'sql_metrics', self.metrics)
+
+    def _collect(self, conn, cursor, statement, parameters, executemany, seconds):
+        if has_request_context() and 'sql_statements' in g:
+            g.sql_statements.append(Statement(statement, cursor.rowcount, seconds))
+        if seconds >= self.app.config['SQL_SLOW_SECONDS']:
+            plan = ''
+            if self.app.config['SQL_SLOW_EXPLAIN'] and not executemany \
+                    and conn.dialect.name == 'postgresql':
+                plan = self._explain(conn, statement, parameters)
+            self.app.logger.warning('Slow statement (%.1fms): %s %s\n%s',
+                                    seconds * 1000, statement, parameters, plan)
+
+    def _explain(self, conn, statement: str, parameters) -> str:
+        """The plan of the statement, or '' if we can't get it.
+
+        We EXPLAIN in a SAVEPOINT, so an error doesn't abort the
+        transaction of the request, and EXPLAIN ANALYZE doesn't keep
+        what the statement writes (but sequences still advance).
+        """
+        analyze = self.app.config['SQL_SLOW_EXPLAIN'] == 'analyze' \
+            and statement.lstrip().upper().startswith('SELECT')
+        # The DBAPI cursor, so we don't run this listener again
+        explain = conn.connection.cursor()
+        try:
+            explain.execute('SAVEPOINT explain_slow_statement')
+        except conn.dialect.dbapi.Error:  # Not in a transaction (autocommit)
+            return ''
+        try:
+            explain.execute(('EXPLAIN ANALYZE ' if analyze else 'EXPLAIN ') + statement,
+                            parameters)
+            return '\n'.join(line for line, in explain)
+        except conn.dialect.dbapi.Error:
+            self.app.logger.exception('Could not explain the slow statement')
+            return ''
+        finally:
+            explain.execute('ROLLBACK TO SAVEPOINT explain_slow_statement')
+            explain.execute('RELEASE SAVEPOINT explain_slow_statement')
+
+    def _start(self):
+        g.sql_statements = []
+
+    def _finish(self, response: Response) -> Response:
+        statements = g.pop('sql_statements', [])
+        seconds = sum(statement.seconds for statement in statements)
+        response.headers['X-SQL-Statements'] = str(len(statements))
+        response.headers['Server-Timing'] = f'db;dur={seconds * 1000:.1f}'
+        with self._lock:
+            # Requests that match no route (i.e. 404) have no endpoint
+            endpoint = request.endpoint or '<unmatched>'
+            metrics = self.endpoints.setdefault(endpoint, {
+                'requests': 0, 'statements': 0, 'seconds': 0.0, 'slowest': []
+            })
+            metrics['requests'] += 1
+            metrics['statements'] += len(statements)
+            metrics['seconds'] += seconds
+            # Each SQL once, with its slowest time
+            slowest = {sql: time for time, sql in metrics['slowest']}
+            for statement in statements:
+                slowest[statement.sql] = max(slowest.get(statement.sql, 0), statement.seconds)
+            metrics['slowest'] = sorted(((time, sql) for sql, time in slowest.items()),
+                                        reverse=True)[:self.SLOWEST]
+        return response
+
+    def metrics(self):
+        """The ``/_metrics`` endpoint."""
+        with self._lock:
+            metrics = {'endpoints': {endpoint: dict(metrics, slowest=list(metrics['slowest']))
+                                     for endpoint, metrics in self.endpoints.items()}}
+        if hasattr(self.engine.pool, 'metrics'):
+            metrics['pool'] = self.engine.pool.metrics.snapshot()
+        return jsonify(metrics)
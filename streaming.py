@@ -0,0 +1,63 @@
+"""
+Responding with many rows without loading all of them.
+
+``str(tuple(Computer.query))`` loads all the computers, keeps them in
+memory, and builds one big string before responding. Instead, we fetch
+the rows in batches from a server-side cursor, and send each batch as
+soon as we have it.
+
+Used by the examples, like in ``a1_intro.py``.
+"""
+
+from itertools import islice
+
+from flask import Response, json, request, stream_with_context
+from sqlalchemy import inspect
+from sqlalchemy.orm import Query
+
+
+def stream_json(query: Query, batch_size: int = 1000) -> Response:
+    """Streams the objects of the query as a JSON array, or as NDJSON
+    (one JSON object per line) if the client accepts
+    ``application/x-ndjson``.
+
+    The query fetches ``batch_size`` rows at a time, so memory does
+    not depend on the number of rows, and the client gets the first
+    rows after the first batch, not after the whole query.
+    """
+    ndjson = request.accept_mimetypes.best_match(
+        ['application/json', 'application/x-ndjson']
+    ) == 'application/x-ndjson'
+    # stream_results uses a server-side cursor in Postgres. Otherwise
+    # psycopg2 downloads all the rows when executing the query
+    query = query.execution_options(stream_results=True).yield_per(batch_size)
+
+    def generate():
+        if not ndjson:
+            yield '['
+        rows = iter(query)
+        first = True
+        # We send a batch at a time, not a row at a time
+        for batch in iter(lambda: list(islice(rows, batch_size)), []):
+            batch = [json.dumps(_to_dict(obj)) for obj in batch]
+            if ndjson:
+                yield '\n'.join(batch) + '\n'
+            else:
+                yield ('' if first else ',') + ','.join(batch)
+            first = False
+        if not ndjson:
+            yield ']'
+
+    # stream_with_context keeps the request, and so the session, alive
+    # while we generate the response
+    return Response(stream_with_context(generate()),
+                    mimetype='application/x-ndjson' if ndjson else 'application/json')
+
+
+def _to_dict(obj) -> dict:
+    """The values of the columns of the object, or of the
+    tuple if the query returns columns (i.e. with_entities).
+    """
+    if hasattr(obj, '_asdict'):
+        return obj._asdict()
+    return {attr.key: getattr(obj, attr.key) for attr in inspect(obj).mapper.column_attrs}